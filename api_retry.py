@@ -0,0 +1,63 @@
+import re
+from typing import Optional
+
+from openai import APIConnectionError, APITimeoutError, RateLimitError
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential_jitter
+
+MAX_ATTEMPTS = 6
+MAX_RATE_LIMIT_WAIT = 60
+
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+_exponential_wait = wait_exponential_jitter(initial=1, max=32)
+
+def _parse_duration(value: str) -> Optional[float]:
+    """Parse an OpenAI reset duration such as '20ms', '1s' or '6m0s' into seconds."""
+    parts = _DURATION_PART.findall(value)
+    if not parts:
+        return None
+    return sum(float(amount) * _DURATION_UNITS[unit] for amount, unit in parts)
+
+def retry_after_seconds(headers) -> Optional[float]:
+    """Return how long the server asked us to wait before retrying, if it said."""
+    if headers.get("retry-after-ms"):
+        try:
+            return float(headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    if headers.get("retry-after"):
+        try:
+            return float(headers["retry-after"])
+        except ValueError:
+            pass
+    resets = [
+        _parse_duration(headers[name])
+        for name in ("x-ratelimit-reset-requests", "x-ratelimit-reset-tokens")
+        if headers.get(name)
+    ]
+    resets = [reset for reset in resets if reset is not None]
+    return max(resets) if resets else None
+
+def wait_for_retry(retry_state) -> float:
+    """Honor the server's hint on rate limits, otherwise back off exponentially with jitter."""
+    exception = retry_state.outcome.exception()
+    if isinstance(exception, RateLimitError):
+        retry_after = retry_after_seconds(exception.response.headers)
+        if retry_after is not None:
+            return min(retry_after, MAX_RATE_LIMIT_WAIT)
+    return _exponential_wait(retry_state)
+
+def log_sleep(retry_state):
+    exception = retry_state.outcome.exception()
+    print(f"API call failed (attempt {retry_state.attempt_number}/{MAX_ATTEMPTS}): {exception}. "
+          f"Retrying in {retry_state.next_action.sleep:.1f}s")
+
+# Retry transient API failures (rate limits, timeouts, connection errors)
+retry_api_call = retry(
+    retry=retry_if_exception_type((RateLimitError, APITimeoutError, APIConnectionError)),
+    wait=wait_for_retry,
+    stop=stop_after_attempt(MAX_ATTEMPTS),
+    before_sleep=log_sleep,
+    reraise=True
+)
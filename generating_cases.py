@@ -1,74 +1,246 @@
-from openai import OpenAI
+from openai import AsyncOpenAI, AuthenticationError, BadRequestError, NotFoundError, PermissionDeniedError
+import argparse
+import asyncio
+import httpx
+import importlib.util
 import json
+import math
+import orjson
 import time
 import os
-from typing import Dict, List
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, FrozenSet, List, Optional, Set, Tuple
 import random
+import re
+import string
 from api_key import key
+from api_retry import retry_api_call
+from jsonl_writer import JsonlWriter
 
 # Set your OpenAI API key
 API_KEY = key
 
+# HTTP/2 needs the optional h2 package (httpx[http2]); fall back to HTTP/1.1 without it
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+# Shared client so the connection pool stays warm across all tasks
+client = AsyncOpenAI(
+    api_key=API_KEY,
+    http_client=httpx.AsyncClient(
+        http2=HTTP2_AVAILABLE,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=50, keepalive_expiry=60)
+    )
+)
+
+# Errors that retrying the same request will not fix
+NON_TRANSIENT_ERRORS = (AuthenticationError, BadRequestError, NotFoundError, PermissionDeniedError)
+
+# Limits on in-flight requests and request rate against the OpenAI API
+MAX_CONCURRENT_REQUESTS = 50
+MAX_REQUESTS_PER_MINUTE = 500
+
+_request_semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+_throttle_lock = asyncio.Lock()
+_last_request_time = 0.0
+
+# Attempts per case when the model returns unusable content
+MAX_CONTENT_ATTEMPTS = 3
+
+# Id and diseases of a submitted Batch API job that hasn't been collected yet
+BATCH_STATE_FILE = "medical_cases_batch.json"
+
+# Buffer size for writing the full cases file in one pass
+WRITE_BUFFER_SIZE = 1 << 20
+
 # Track generated diseases
 generated_diseases: List[str] = []
 
+# Diseases requested per call when building the disease list, and the
+# specialties those calls are spread across
+DISEASES_PER_REQUEST = 100
+MAX_DISEASE_ROUNDS = 10
+SPECIALTIES = [
+    "cardiology", "pulmonology", "gastroenterology", "hepatology", "nephrology",
+    "endocrinology", "hematology", "oncology", "infectious disease", "rheumatology",
+    "neurology", "psychiatry", "dermatology", "ophthalmology", "otolaryngology",
+    "obstetrics and gynecology", "urology", "orthopedics", "pediatrics", "immunology and genetics"
+]
+
+# Normalized names and a token -> token-set index of every accepted diagnosis,
+# used by validate_diagnosis for exact and near-duplicate lookups
+SIMILARITY_THRESHOLD = 0.8
+_PUNCTUATION_TABLE = str.maketrans(string.punctuation, " " * len(string.punctuation))
+_LIST_MARKER = re.compile(r"^\s*\d+[.)]\s*")
+_ICD10_CODE = re.compile(r"\bICD-10\b[^A-Za-z0-9]*(?:code\s*)?[A-Z]\d{2}", re.IGNORECASE)
+_seen_names: Set[str] = set()
+_token_index: Dict[str, Set[FrozenSet[str]]] = {}
+
+# Static instructions go in the system message so the prompt prefix is identical
+# across requests; the per-disease details go in the user message.
+CASE_INSTRUCTIONS = """You are an expert physician. Generate a realistic medical case for the diagnosis and patient demographics given by the user.
+
+CRITICAL REQUIREMENTS:
+1. The vignette must be 3-4 sentences maximum
+2. The vignette must match the given demographics (age and sex)
+3. The vignette must be clinically accurate for the diagnosis
+4. The vignette must include: demographics, chief complaint, key physical exam findings, and critical lab/imaging results
+
+Output format (must be valid JSON with exactly two fields: 'doctor_vignette' and 'actual_diagnosis'):
+{
+    "doctor_vignette": "A concise medical vignette that includes: 1) Demographics (age, sex), 2) Chief complaint, 3) Key physical exam findings, and 4) Critical lab/imaging results",
+    "actual_diagnosis": "The diagnosis exactly as given"
+}"""
+
+BATCH_CASE_INSTRUCTIONS = """You are an expert physician. Generate a realistic medical case for each diagnosis in the numbered list given by the user.
+
+CRITICAL REQUIREMENTS:
+1. Each vignette must be 3-4 sentences maximum
+2. Each vignette must match the demographics given under its diagnosis
+3. Each vignette must be clinically accurate for the diagnosis
+4. Each vignette must include: demographics, chief complaint, key physical exam findings, and critical lab/imaging results
+
+Output format (must be a valid JSON object with a single field 'cases', a list of objects with exactly two fields: 'doctor_vignette' and 'actual_diagnosis'):
+{
+    "cases": [
+        {
+            "doctor_vignette": "A concise medical vignette that includes: 1) Demographics (age, sex), 2) Chief complaint, 3) Key physical exam findings, and 4) Critical lab/imaging results",
+            "actual_diagnosis": "The diagnosis exactly as given, without the demographics"
+        }
+    ]
+}
+
+Return exactly one case per diagnosis, in the same order as the list."""
+
+CASE_PROMPT_TEMPLATE = """Diagnosis: {disease}
+Demographics: {age}-year-old {sex}"""
+BATCH_CASE_LINE_TEMPLATE = """{index}. Diagnosis: {disease}
+   Demographics: {age}-year-old {sex}"""
+
+# Demographics drawn for each generated case
+AGES = range(1, 151)
+SEXES = ["male", "female"]
+
 def validate_case(case):
     # Ensure the case is a dict with the required fields and non-empty values
     if not isinstance(case, dict):
         return False
     if "doctor_vignette" not in case or "actual_diagnosis" not in case:
         return False
+    if not isinstance(case["doctor_vignette"], str) or not isinstance(case["actual_diagnosis"], str):
+        return False
     if not case["doctor_vignette"].strip() or not case["actual_diagnosis"].strip():
         return False
     return True
 
+def extract_json_object(text: str):
+    """Return the first balanced {...} substring of text, or None if there is none."""
+    start = text.find('{')
+    if start == -1:
+        return None
+    depth = 0
+    in_string = False
+    escaped = False
+    for i in range(start, len(text)):
+        char = text[i]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == '\\':
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char == '{':
+            depth += 1
+        elif char == '}':
+            depth -= 1
+            if depth == 0:
+                return text[start:i+1]
+    return None
+
 def parse_case_response(response_content):
-    # Try to parse as JSON, fallback to extracting fields manually
+    # Parse the first JSON object in the response
+    json_str = extract_json_object(response_content)
+    if json_str is None:
+        return None
     try:
-        # First try to find JSON content within the response
-        start_idx = response_content.find('{')
-        end_idx = response_content.rfind('}')
-        if start_idx != -1 and end_idx != -1:
-            json_str = response_content[start_idx:end_idx+1]
-            case = json.loads(json_str)
-            if validate_case(case):
-                return case
-    except Exception:
-        pass
-    
-    # Fallback: try to extract fields manually
-    try:
-        lines = response_content.splitlines()
-        vignette = ""
-        diagnosis = ""
-        for line in lines:
-            if 'doctor_vignette' in line.lower():
-                vignette = line.split(':', 1)[-1].strip(' ",')
-            if 'actual_diagnosis' in line.lower():
-                diagnosis = line.split(':', 1)[-1].strip(' ",')
-        if vignette and diagnosis:
-            return {"doctor_vignette": vignette, "actual_diagnosis": diagnosis}
-    except Exception:
-        pass
+        case = orjson.loads(json_str)
+    except orjson.JSONDecodeError:
+        # Lenient parse for LLM output with raw control characters in strings
+        try:
+            case = json.loads(json_str, strict=False)
+        except json.JSONDecodeError:
+            return None
+    if validate_case(case):
+        return case
     return None
 
-def validate_diagnosis(diagnosis: str, diseases_to_avoid: List[str]) -> bool:
-    """Validate that the diagnosis is not in the list of diseases to avoid."""
-    diagnosis_lower = diagnosis.lower()
-    for disease in diseases_to_avoid:
-        if disease.lower() in diagnosis_lower or diagnosis_lower in disease.lower():
-            print(f"REJECTED: '{diagnosis}' is too similar to existing diagnosis '{disease}'")
+async def _throttle():
+    """Space out request starts so we stay under MAX_REQUESTS_PER_MINUTE."""
+    global _last_request_time
+    async with _throttle_lock:
+        wait = _last_request_time + 60 / MAX_REQUESTS_PER_MINUTE - time.monotonic()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        _last_request_time = time.monotonic()
+
+@retry_api_call
+async def create_chat_completion(**kwargs):
+    """Create a chat completion, bounded by the shared concurrency and rate limits."""
+    async with _request_semaphore:
+        await _throttle()
+        return await client.chat.completions.create(**kwargs)
+
+async def complete_case_request(**kwargs):
+    """Return the completion text for a case request, or None if it was cut off at max_tokens."""
+    response = await create_chat_completion(**kwargs)
+    choice = response.choices[0]
+    if choice.finish_reason == "length":
+        print("Response was cut off at max_tokens")
+        return None
+    return choice.message.content
+
+def normalize_diagnosis(diagnosis: str) -> str:
+    """Lowercase a diagnosis, drop list numbering and its ICD-10 code suffix, and strip punctuation."""
+    name = _LIST_MARKER.sub("", diagnosis).lower().split("icd-10", 1)[0]
+    return " ".join(name.translate(_PUNCTUATION_TABLE).split())
+
+def register_diagnosis(diagnosis: str):
+    """Record a diagnosis so later duplicates are rejected by validate_diagnosis."""
+    name = normalize_diagnosis(diagnosis)
+    tokens = frozenset(name.split())
+    _seen_names.add(name)
+    for token in tokens:
+        _token_index.setdefault(token, set()).add(tokens)
+
+def validate_diagnosis(diagnosis: str) -> bool:
+    """Validate that the diagnosis is not a duplicate or near-duplicate of one already registered."""
+    name = normalize_diagnosis(diagnosis)
+    if not name or not _ICD10_CODE.search(diagnosis):
+        print(f"REJECTED: '{diagnosis}' is not a diagnosis with an ICD-10 code")
+        return False
+    if name in _seen_names:
+        print(f"REJECTED: '{diagnosis}' duplicates an existing diagnosis")
+        return False
+
+    # Only token sets sharing at least one token can be similar
+    tokens = frozenset(name.split())
+    candidates = set()
+    for token in tokens:
+        candidates.update(_token_index.get(token, ()))
+    for existing in candidates:
+        if len(tokens & existing) / len(tokens | existing) > SIMILARITY_THRESHOLD:
+            print(f"REJECTED: '{diagnosis}' is too similar to existing diagnosis '{' '.join(sorted(existing))}'")
             return False
     return True
 
-def generate_unique_diseases(num_diseases: int = 500) -> List[str]:
-    """Generate a list of unique medical diagnoses with ICD-10 codes."""
-    prompt = """You are an expert physician. Generate a list of unique medical diagnoses with their ICD-10 codes.
+async def request_diseases(count: int, specialties: List[str], avoid: List[str]) -> List[str]:
+    """Ask for `count` diagnoses from the given specialties, skipping those in `avoid`."""
+    prompt = f"""You are an expert physician. Generate a list of {count} unique medical diagnoses with their ICD-10 codes.
     Each diagnosis must be:
     1. A real medical condition with a valid ICD-10 code
     2. Completely distinct from other diagnoses (no variations or subtypes)
-    3. Cover a wide range of medical specialties
+    3. Drawn from these medical specialties: {", ".join(specialties)}
     4. Include both common and rare conditions
     
     Format each diagnosis as: "Diagnosis name, ICD-10 code X00.0"
@@ -79,92 +251,292 @@ def generate_unique_diseases(num_diseases: int = 500) -> List[str]:
     Pulmonary embolism, ICD-10 code I26.9
     Multiple sclerosis, ICD-10 code G35
     """
-    
+    if avoid:
+        prompt += "\nDo not repeat any of these already generated diagnoses:\n" + "\n".join(avoid)
+
+    response = await create_chat_completion(
+        model="gpt-4o-mini",
+        messages=[
+            {"role": "system", "content": "You are an expert physician. Generate unique medical diagnoses with ICD-10 codes."},
+            {"role": "user", "content": prompt}
+        ],
+        temperature=0.7,
+        max_tokens=4000
+    )
+    content = response.choices[0].message.content
+    return [line.strip() for line in content.split('\n') if line.strip()]
+
+async def generate_unique_diseases(num_diseases: int = 500) -> List[str]:
+    """Generate a list of unique medical diagnoses with ICD-10 codes."""
     diseases = []
+    failed_rounds = 0
     print(f"\nGenerating unique diseases (target: {num_diseases})...")
     
-    while len(diseases) < num_diseases:
-        try:
-            client = OpenAI(api_key=API_KEY)
-            response = client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[
-                    {"role": "system", "content": "You are an expert physician. Generate unique medical diagnoses with ICD-10 codes."},
-                    {"role": "user", "content": prompt}
-                ],
-                temperature=0.7,
-                max_tokens=1000
-            )
-            content = response.choices[0].message.content
-            new_diseases = [line.strip() for line in content.split('\n') if line.strip()]
-            
-            # Validate and add unique diseases
+    for round_number in range(1, MAX_DISEASE_ROUNDS + 1):
+        if len(diseases) >= num_diseases:
+            break
+        
+        # Request all remaining diseases at once, split across concurrent calls
+        # that each cover a different slice of specialties
+        num_calls = math.ceil((num_diseases - len(diseases)) / DISEASES_PER_REQUEST)
+        avoid = generated_diseases + diseases
+        responses = await asyncio.gather(
+            *(request_diseases(DISEASES_PER_REQUEST, SPECIALTIES[i::num_calls] or SPECIALTIES, avoid) for i in range(num_calls)),
+            return_exceptions=True
+        )
+        
+        # Validate and add unique diseases, stopping at the target
+        errors = [response for response in responses if isinstance(response, Exception)]
+        for error in errors:
+            print(f"Error generating diseases (round {round_number}): {error}")
+            if isinstance(error, NON_TRANSIENT_ERRORS):
+                raise error
+        for new_diseases in responses:
+            if isinstance(new_diseases, Exception):
+                continue
             for disease in new_diseases:
-                if disease not in diseases:
+                if len(diseases) >= num_diseases:
+                    break
+                if validate_diagnosis(disease):
+                    register_diagnosis(disease)
                     diseases.append(disease)
                     print(f"Generated unique disease {len(diseases)}/{num_diseases}: {disease}")
-                    if len(diseases) >= num_diseases:
-                        break
-                        
-        except Exception as e:
-            print(f"Error generating diseases: {e}")
-            time.sleep(1)
-    
-    print(f"\nSuccessfully generated {len(diseases)} unique diseases!")
-    return diseases[:num_diseases]
-
-def generate_case_for_disease(disease: str) -> Dict:
-    """Generate a medical case for a specific disease."""
-    # Generate random demographics
-    age = random.randint(1, 150)
-    sex = random.choice(["male", "female"])
+        
+        # Back off exponentially while whole rounds keep failing
+        if len(errors) == len(responses):
+            failed_rounds += 1
+            if round_number < MAX_DISEASE_ROUNDS:
+                await asyncio.sleep(min(2 ** failed_rounds, 60))
+        else:
+            failed_rounds = 0
     
-    prompt = f"""You are an expert physician. Generate a realistic medical case for this diagnosis: {disease}
+    if len(diseases) < num_diseases:
+        print(f"\nStopped after {MAX_DISEASE_ROUNDS} rounds with {len(diseases)}/{num_diseases} unique diseases")
+    else:
+        print(f"\nSuccessfully generated {len(diseases)} unique diseases!")
+    return diseases
 
-CRITICAL REQUIREMENTS:
-1. The vignette must be 3-4 sentences maximum
-2. The vignette must match the demographics: {age}-year-old {sex}
-3. The vignette must be clinically accurate for the diagnosis
-4. The vignette must include: demographics, chief complaint, key physical exam findings, and critical lab/imaging results
+def build_case_request(disease: str, age: int, sex: str) -> Dict:
+    """Build the chat completion request body for a single-disease case."""
+    prompt = CASE_PROMPT_TEMPLATE.format(disease=disease, age=age, sex=sex)
 
-Output format (must be valid JSON):
-{{
-    "doctor_vignette": "A concise medical vignette that includes: 1) Demographics (age, sex), 2) Chief complaint, 3) Key physical exam findings, and 4) Critical lab/imaging results",
-    "actual_diagnosis": "{disease}"
-}}
+    return {
+        "model": "gpt-4o-mini",
+        "messages": [
+            {"role": "system", "content": CASE_INSTRUCTIONS},
+            {"role": "user", "content": prompt}
+        ],
+        "response_format": {"type": "json_object"},
+        "temperature": 0.7,
+        "max_tokens": 150
+    }
 
-Generate a case following the exact format above, ensuring the vignette is appropriate for a {age}-year-old {sex} patient with {disease}."""
-
-    content = None
-    for attempt in range(3):
+async def generate_case_for_disease(disease: str, age: int, sex: str) -> Dict:
+    """Generate a medical case for a specific disease and patient demographics."""
+    # Transport errors are retried inside create_chat_completion; this loop only
+    # re-requests when the model returns content we can't use
+    for attempt in range(MAX_CONTENT_ATTEMPTS):
         try:
-            client = OpenAI(api_key=API_KEY)
-            response = client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[
-                    {"role": "system", "content": "You are an expert physician. You must return a valid JSON object with exactly two fields: 'doctor_vignette' and 'actual_diagnosis'."},
-                    {"role": "user", "content": prompt}
-                ],
-                temperature=0.7,
-                max_tokens=150
-            )
-            content = response.choices[0].message.content
-            case = parse_case_response(content)
-            if validate_case(case):
-                return case
+            content = await complete_case_request(**build_case_request(disease, age, sex))
+        except NON_TRANSIENT_ERRORS:
+            raise
         except Exception as e:
-            print(f"Error generating case (attempt {attempt+1}): {e}")
-            if content:
-                print(f"Response content: {content}")
-        time.sleep(1)
+            print(f"Error generating case for '{disease}': {e}")
+            break
+        case = parse_case_response(content) if content else None
+        if validate_case(case):
+            # Store the requested disease as the label, not the model's echo of it
+            case["actual_diagnosis"] = disease
+            return case
+        print(f"Invalid case for '{disease}' (attempt {attempt+1})")
+        if content:
+            print(f"Response content: {content}")
     return {"doctor_vignette": "Failed to generate vignette.", "actual_diagnosis": disease}
 
-def generate_cases_parallel(num_cases=500, max_workers=5):
-    """Generate cases in parallel using ThreadPoolExecutor"""
+async def generate_cases_batch(patients: List[Tuple[str, int, str]]) -> List[Dict]:
+    """Generate medical cases for a batch of (disease, age, sex) patients in a single request."""
+    disease_list = "\n".join(
+        BATCH_CASE_LINE_TEMPLATE.format(index=i, disease=disease, age=age, sex=sex)
+        for i, (disease, age, sex) in enumerate(patients, 1)
+    )
+
+    prompt = f"""Diagnoses ({len(patients)} total):
+{disease_list}"""
+
+    content = None
+    try:
+        content = await complete_case_request(
+            model="gpt-4o-mini",
+            messages=[
+                {"role": "system", "content": BATCH_CASE_INSTRUCTIONS},
+                {"role": "user", "content": prompt}
+            ],
+            response_format={"type": "json_object"},
+            temperature=0.7,
+            max_tokens=150 * len(patients)
+        )
+        raw_cases = orjson.loads(content).get("cases", []) if content else []
+
+        # Match returned cases to requested patients by diagnosis, not position,
+        # so a dropped or reordered entry can't shift cases onto the wrong patient
+        patient_index = {normalize_diagnosis(disease): i for i, (disease, _, _) in enumerate(patients)}
+        cases = [None] * len(patients)
+        for raw_case in raw_cases:
+            case = raw_case if isinstance(raw_case, dict) else parse_case_response(str(raw_case))
+            if not validate_case(case):
+                continue
+            i = patient_index.get(normalize_diagnosis(case["actual_diagnosis"]))
+            if i is None:
+                print(f"Ignoring case for unrequested diagnosis: {case['actual_diagnosis']}")
+                continue
+            if cases[i] is None:
+                # Store the requested disease as the label, not the model's echo of it
+                case["actual_diagnosis"] = patients[i][0]
+                cases[i] = case
+
+        # Regenerate any patients the model dropped or returned invalid cases for
+        missing = [i for i, case in enumerate(cases) if case is None]
+        regenerated = await asyncio.gather(*(generate_case_for_disease(*patients[i]) for i in missing))
+        for i, case in zip(missing, regenerated):
+            cases[i] = case
+        return cases
+    except NON_TRANSIENT_ERRORS:
+        raise
+    except Exception as e:
+        print(f"Error generating case batch: {e}")
+        if content:
+            print(f"Response content: {content}")
+    # Fall back to one request per disease
+    return list(await asyncio.gather(*(generate_case_for_disease(*patient) for patient in patients)))
+
+def load_batch_state(filename=BATCH_STATE_FILE):
+    """Load the id and diseases of a submitted but uncollected batch, if any"""
+    try:
+        with open(filename, 'rb') as f:
+            return orjson.loads(f.read())
+    except (FileNotFoundError, orjson.JSONDecodeError):
+        return None
+
+def save_batch_state(batch_id: str, diseases: List[str], filename=BATCH_STATE_FILE):
+    """Record a submitted batch so it can be collected after a crash or Ctrl-C"""
+    with open(filename, 'wb') as f:
+        f.write(orjson.dumps({"batch_id": batch_id, "diseases": diseases}))
+        f.flush()
+        os.fsync(f.fileno())
+
+def clear_batch_state(filename=BATCH_STATE_FILE):
+    try:
+        os.remove(filename)
+    except FileNotFoundError:
+        pass
+
+@retry_api_call
+async def retrieve_batch(batch_id: str):
+    return await client.batches.retrieve(batch_id)
+
+@retry_api_call
+async def download_file(file_id: str):
+    return await client.files.content(file_id)
+
+async def submit_case_batch(patients: List[Tuple[str, int, str]]) -> str:
+    """Submit one case request per (disease, age, sex) patient to the OpenAI Batch API.
+
+    Batch jobs cost half as much as real-time requests but may take up to 24 hours.
+    The batch id is saved to BATCH_STATE_FILE before returning.
+    """
+    batch_input = b"".join(
+        orjson.dumps({
+            "custom_id": disease,
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": build_case_request(disease, age, sex)
+        }) + b"\n"
+        for disease, age, sex in patients
+    )
+
+    input_file = await client.files.create(
+        file=("medical_cases_batch.jsonl", batch_input),
+        purpose="batch"
+    )
+    batch = await client.batches.create(
+        input_file_id=input_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h"
+    )
+    save_batch_state(batch.id, [disease for disease, _, _ in patients])
+    print(f"Submitted batch {batch.id} with {len(patients)} requests (resume with --resume-batch {batch.id})")
+    return batch.id
+
+async def collect_case_batch(batch_id: str, diseases: Optional[List[str]] = None, poll_interval: float = 30, max_poll_interval: float = 600) -> List[Dict]:
+    """Wait for a submitted batch to finish and return its cases.
+
+    With `diseases`, cases come back in that order and failed requests get a
+    placeholder; without it, only the successful cases are returned.
+    """
+    batch = await retrieve_batch(batch_id)
+
+    # Poll with exponential backoff until the batch reaches a terminal state
+    while batch.status not in ("completed", "failed", "expired", "cancelled"):
+        await asyncio.sleep(poll_interval)
+        poll_interval = min(poll_interval * 2, max_poll_interval)
+        batch = await retrieve_batch(batch_id)
+        counts = batch.request_counts
+        progress = f" ({counts.completed}/{counts.total} done)" if counts else ""
+        print(f"Batch {batch.id} status: {batch.status}{progress}")
+
+    cases_by_disease = {}
+    if batch.output_file_id:
+        output = await download_file(batch.output_file_id)
+        for line in output.text.splitlines():
+            if not line.strip():
+                continue
+            result = orjson.loads(line)
+            response = result.get("response") or {}
+            if response.get("status_code") != 200:
+                print(f"Batch request failed for '{result['custom_id']}': {result.get('error')}")
+                continue
+            choice = response["body"]["choices"][0]
+            if choice.get("finish_reason") == "length":
+                print(f"Batch response for '{result['custom_id']}' was cut off at max_tokens")
+                continue
+            case = parse_case_response(choice["message"]["content"])
+            if validate_case(case):
+                case["actual_diagnosis"] = result["custom_id"]
+                cases_by_disease[result["custom_id"]] = case
+    else:
+        print(f"Batch {batch.id} finished with status '{batch.status}' and no output")
+
+    if diseases is None:
+        return list(cases_by_disease.values())
+    return [
+        cases_by_disease.get(disease, {"doctor_vignette": "Failed to generate vignette.", "actual_diagnosis": disease})
+        for disease in diseases
+    ]
+
+async def generate_cases_parallel(num_cases=500, batch_size=16, use_batch_api=False, resume_batch_id=None):
+    """Generate cases concurrently using asyncio"""
     # Load existing cases if any
     cases = load_cases()
     start_idx = len(cases)
     
+    # Collect a previously submitted batch before generating anything new
+    batch_state = load_batch_state()
+    if batch_state and not (use_batch_api or resume_batch_id):
+        print(f"Found uncollected batch {batch_state['batch_id']}; rerun with --batch to collect it")
+    if resume_batch_id or (use_batch_api and batch_state):
+        batch_id = resume_batch_id or batch_state["batch_id"]
+        diseases = batch_state["diseases"] if batch_state and batch_state["batch_id"] == batch_id else None
+        print(f"Collecting batch {batch_id}...")
+        writer = JsonlWriter("medical_cases.jsonl")
+        for case in await collect_case_batch(batch_id, diseases):
+            cases.append(case)
+            writer.append(case)
+        writer.close()
+        clear_batch_state()
+        print(f"\nBatch collected! Total cases: {len(cases)}")
+        print("Results have been saved to 'medical_cases.jsonl'")
+        return
+    
     if start_idx >= num_cases:
         print(f"Already have {start_idx} cases. No new cases needed.")
         return
@@ -173,51 +545,105 @@ def generate_cases_parallel(num_cases=500, max_workers=5):
     
     # First generate unique diseases
     print("Generating unique diseases...")
-    unique_diseases = generate_unique_diseases(num_cases - start_idx)
+    unique_diseases = await generate_unique_diseases(num_cases - start_idx)
     print(f"Generated {len(unique_diseases)} unique diseases")
     
-    # Generate cases in parallel
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        # Submit all tasks
-        futures = [executor.submit(generate_case_for_disease, disease) for disease in unique_diseases]
-        
-        # Process completed tasks
-        for i, future in enumerate(as_completed(futures)):
-            try:
-                case = future.result()
+    # Draw all demographics up front and pair them with their diseases
+    ages = random.choices(AGES, k=len(unique_diseases))
+    sexes = random.choices(SEXES, k=len(unique_diseases))
+    patients = list(zip(unique_diseases, ages, sexes))
+    
+    if use_batch_api:
+        batch_id = await submit_case_batch(patients)
+        writer = JsonlWriter("medical_cases.jsonl")
+        for case in await collect_case_batch(batch_id, unique_diseases):
+            cases.append(case)
+            writer.append(case)
+        writer.close()
+        clear_batch_state()
+        print(f"\nGeneration complete! Total cases: {len(cases)}")
+        print("Results have been saved to 'medical_cases.jsonl'")
+        return
+    
+    writer = JsonlWriter("medical_cases.jsonl")
+    
+    # Generate cases concurrently, one task per batch of diseases
+    batches = [patients[i:i + batch_size] for i in range(0, len(patients), batch_size)]
+    tasks = [generate_cases_batch(batch) for batch in batches]
+    
+    # Process tasks as they complete
+    for next_batch in asyncio.as_completed(tasks):
+        try:
+            for case in await next_batch:
                 cases.append(case)
-                
-                # Save after each case
-                save_cases(cases)
+                writer.append(case)
                 
                 # Print progress
-                print(f"\nGenerated case {start_idx + i + 1}/{num_cases}:")
+                print(f"\nGenerated case {len(cases)}/{num_cases}:")
                 print(f"Diagnosis: {case['actual_diagnosis']}")
                 print(f"Vignette: {case['doctor_vignette']}")
                 print("-" * 80)
-                
-            except Exception as e:
-                print(f"Error processing case: {e}")
+            
+        except NON_TRANSIENT_ERRORS:
+            writer.close()
+            raise
+        except Exception as e:
+            print(f"Error processing case batch: {e}")
     
+    writer.close()
     print(f"\nGeneration complete! Total cases: {len(cases)}")
-    print("Results have been saved to 'medical_cases.json'")
+    print("Results have been saved to 'medical_cases.jsonl'")
 
-def save_cases(cases, filename="medical_cases.json"):
-    """Save cases to JSON file with pretty printing"""
-    with open(filename, 'w') as f:
-        json.dump(cases, f, indent=2)
+def load_cases(filename="medical_cases.jsonl"):
+    """Load existing cases from JSONL file, skipping lines that fail to decode
 
-def load_cases(filename="medical_cases.json"):
-    """Load existing cases from JSON file"""
+    A torn last line left by a crash mid-append is truncated from the file so
+    the next append starts on a clean line.
+    """
+    cases = []
     try:
-        with open(filename, 'r') as f:
-            cases = json.load(f)
-            # Initialize the generated_diseases list with diseases from existing cases
-            global generated_diseases
-            generated_diseases = [case["actual_diagnosis"] for case in cases]
-            return cases
-    except (FileNotFoundError, json.JSONDecodeError):
+        with open(filename, 'rb+') as f:
+            lines = f.readlines()
+            offset = 0
+            for line_number, line in enumerate(lines, 1):
+                offset += len(line)
+                if not line.strip():
+                    continue
+                try:
+                    cases.append(orjson.loads(line))
+                except orjson.JSONDecodeError:
+                    if line_number == len(lines) and not line.endswith(b"\n"):
+                        print(f"Warning: truncating incomplete last line {line_number} of {filename}")
+                        f.truncate(offset - len(line))
+                    else:
+                        print(f"Warning: skipping malformed line {line_number} of {filename}")
+                    continue
+                if line_number == len(lines) and not line.endswith(b"\n"):
+                    f.write(b"\n")
+    except FileNotFoundError:
         return []
+    
+    # Initialize the generated_diseases list with diseases from existing cases
+    global generated_diseases
+    generated_diseases = [case["actual_diagnosis"] for case in cases]
+    for diagnosis in generated_diseases:
+        register_diagnosis(diagnosis)
+    return cases
+
+def finalize_cases(filename="medical_cases.jsonl", output_filename="medical_cases.json"):
+    """Convert the JSONL cases file into a pretty-printed JSON array"""
+    cases = load_cases(filename)
+    with open(output_filename, 'wb', buffering=WRITE_BUFFER_SIZE) as f:
+        f.write(orjson.dumps(cases, option=orjson.OPT_INDENT_2))
+    print(f"Wrote {len(cases)} cases to '{output_filename}'")
 
 if __name__ == "__main__":
-    generate_cases_parallel(num_cases=500, max_workers=5)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Generate medical cases")
+    parser.add_argument("--batch", action="store_true", help="Submit generation through the OpenAI Batch API (cheaper, up to 24h turnaround)")
+    parser.add_argument("--resume-batch", metavar="BATCH_ID", help="Collect the results of a previously submitted Batch API job")
+    parser.add_argument("--finalize", action="store_true", help="Convert medical_cases.jsonl into a pretty-printed medical_cases.json and exit")
+    args = parser.parse_args()
+    if args.finalize:
+        finalize_cases()
+    else:
+        asyncio.run(generate_cases_parallel(num_cases=500, use_batch_api=args.batch, resume_batch_id=args.resume_batch))
\ No newline at end of file
@@ -0,0 +1,80 @@
+import atexit
+import os
+import signal
+import time
+
+import orjson
+
+class JsonlWriter:
+    """Append records to a JSONL file, batching writes by count and time.
+
+    Pending records are flushed once `flush_every` have accumulated or
+    `flush_interval` seconds have passed since the last flush, and on exit or
+    Ctrl-C. The file is fsynced only when the writer is closed.
+    """
+
+    def __init__(self, filename, flush_every=16, flush_interval=10.0, truncate=False):
+        self.filename = filename
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self._file = open(filename, 'wb' if truncate else 'ab')
+        self._pending = []
+        self._last_flush = time.monotonic()
+        self._flushing = False
+        self._deferred_sigint = None
+
+        atexit.register(self.close)
+        self._previous_sigint = signal.getsignal(signal.SIGINT)
+        signal.signal(signal.SIGINT, self._handle_sigint)
+
+    def append(self, record):
+        self._pending.append(orjson.dumps(record) + b"\n")
+        if len(self._pending) >= self.flush_every or time.monotonic() - self._last_flush > self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        if self._file.closed or self._flushing:
+            return
+        self._flushing = True
+        try:
+            # Clear pending records only once they are written
+            if self._pending:
+                self._file.write(b"".join(self._pending))
+                self._file.flush()
+                self._pending.clear()
+            self._last_flush = time.monotonic()
+        finally:
+            self._flushing = False
+
+        # Ctrl-C during the write was held back until the records were on disk
+        if self._deferred_sigint:
+            signum, frame = self._deferred_sigint
+            self._deferred_sigint = None
+            self._chain_sigint(signum, frame)
+
+    def close(self):
+        """Flush pending records, fsync and close the file."""
+        if self._file.closed:
+            return
+        self.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        atexit.unregister(self.close)
+        if signal.getsignal(signal.SIGINT) == self._handle_sigint:
+            signal.signal(signal.SIGINT, self._previous_sigint)
+
+    def _handle_sigint(self, signum, frame):
+        if self._flushing:
+            self._deferred_sigint = (signum, frame)
+            return
+        self._deferred_sigint = None
+        self.flush()
+        self._chain_sigint(signum, frame)
+
+    def _chain_sigint(self, signum, frame):
+        if self._previous_sigint == signal.SIG_IGN:
+            return
+        if callable(self._previous_sigint):
+            self._previous_sigint(signum, frame)
+        else:
+            raise KeyboardInterrupt
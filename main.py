@@ -1,91 +1,125 @@
-from openai import OpenAI
+from openai import AsyncOpenAI
+import asyncio
+import httpx
+import importlib.util
 import os
-import json
+import orjson
 from api_key import key
+from api_retry import retry_api_call
+from jsonl_writer import JsonlWriter
+from response_cache import cached_completion
 
 API_KEY = key
-client = OpenAI(api_key=API_KEY)
 
-def load_cases(filename="medical_cases.json"):
-    """Load cases from JSON file"""
-    try:
-        with open(filename, 'r') as f:
-            return json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError) as e:
-        print(f"Error loading cases: {e}")
-        return []
+# HTTP/2 needs the optional h2 package (httpx[http2]); fall back to HTTP/1.1 without it
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
 
-def probabilistic_inference(doctor_vignette):
-    response = client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[
-            {"role": "system", "content": f"""You are an expert medical diagnosis assistant. Based on the patient information provided below, determine the top 10 most likely diagnoses, ordered from most to least likely.
+client = AsyncOpenAI(
+    api_key=API_KEY,
+    http_client=httpx.AsyncClient(
+        http2=HTTP2_AVAILABLE,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=50, keepalive_expiry=60)
+    )
+)
 
-Patient Information: {doctor_vignette}
+# Limit on cases processed concurrently
+MAX_CONCURRENT_CASES = 32
 
-Instructions:
-1. Return EXACTLY 10 diseases, ordered from most to least likely
-2. Each disease should be on its own line
-3. Use the FULL, proper medical name for each diagnosis (e.g., "Heart Failure" not "Failure", "Chronic Obstructive Pulmonary Disease" not "COPD")
-4. Include both common and rare diagnoses that fit the symptom profile
-5. Do not include any additional text, explanations, or formatting
-6. Do not include probabilities or other metadata
-
-Example format:
-Heart Failure
-Chronic Obstructive Pulmonary Disease
-Pneumonia
-...etc."""}
-        ]
-    )
-    answer = response.choices[0].message.content
-    diseases = [d.strip() for d in answer.split('\n') if d.strip()]
-    return diseases
+# Buffer size for writing the full results file in one pass
+WRITE_BUFFER_SIZE = 1 << 20
 
-def deductive_inference(doctor_vignette, least_likely_disease):
-    response = client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[
-            {"role": "system", "content": f"""You are a medical expert using differential diagnosis.
-    
-Patient Information: {doctor_vignette}
+def load_cases(filename="medical_cases.jsonl"):
+    """Load cases from JSONL file, skipping lines that fail to decode"""
+    cases = []
+    try:
+        with open(filename, 'rb') as f:
+            for line_number, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    cases.append(orjson.loads(line))
+                except orjson.JSONDecodeError as e:
+                    print(f"Warning: skipping malformed line {line_number} of {filename}: {e}")
+    except FileNotFoundError as e:
+        print(f"Error loading cases: {e}")
+    return cases
 
-Disease to rule out: {least_likely_disease}
+# Static instructions go in the system message so the prompt prefix is identical
+# across cases; the vignette goes in the user message.
+DIAGNOSIS_INSTRUCTIONS = """You are an expert medical diagnosis assistant using differential diagnosis. Based on the patient information provided by the user:
+1. Determine the top 10 most likely diagnoses, ordered from most to least likely
+2. Generate a single, focused question that would help rule out the least likely of those diagnoses (the last one in your list)
 
-Generate a single, focused question that would help rule out this disease. Since this is the least likely diagnosis, focus on finding a critical symptom or sign that, if present, would strongly suggest this disease is NOT the correct diagnosis.
+Diagnosis instructions:
+1. Return EXACTLY 10 diseases, ordered from most to least likely
+2. Use the FULL, proper medical name for each diagnosis (e.g., "Heart Failure" not "Failure", "Chronic Obstructive Pulmonary Disease" not "COPD")
+3. Include both common and rare diagnoses that fit the symptom profile
+4. Do not include probabilities or other metadata
 
-Guidelines:
-1. Focus on finding a critical symptom or sign that would definitively rule out this disease
+Question guidelines:
+1. Focus on finding a critical symptom or sign that, if present, would strongly suggest the least likely disease is NOT the correct diagnosis
 2. Questions should be direct and answerable with simple yes/no responses
 3. Refer to the patient as "you" not "the patient"
-4. Make the question specific to the disease being considered
+4. Make the question specific to the disease being ruled out
 5. Return ONLY the question, with no additional text, numbering, or formatting
 
-Example for a rare disease like "Leprosy":
-"Have you noticed any loss of sensation in your skin patches?"
+Example questions:
+For a rare disease like "Leprosy": Have you noticed any loss of sensation in your skin patches?
+For "Acute Myeloid Leukemia": Have you had any unusual bleeding or bruising recently?"""
 
-Example for "Acute Myeloid Leukemia":
-"Have you had any unusual bleeding or bruising recently?"""}
-        ]
+DIAGNOSIS_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "differential_diagnosis",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "diseases": {"type": "array", "items": {"type": "string"}},
+                "ruling_out_question": {"type": "string"}
+            },
+            "required": ["diseases", "ruling_out_question"],
+            "additionalProperties": False
+        }
+    }
+}
+
+def is_valid_diagnosis_response(content) -> bool:
+    """Check that a response parses into a non-empty differential and a question."""
+    try:
+        result = orjson.loads(content)
+    except orjson.JSONDecodeError:
+        return False
+    return (
+        isinstance(result, dict)
+        and isinstance(result.get("diseases"), list)
+        and any(isinstance(d, str) and d.strip() for d in result["diseases"])
+        and isinstance(result.get("ruling_out_question"), str)
     )
-    answer = response.choices[0].message.content
-    return answer.strip()
 
-def main():
-    # Load cases from JSON file
-    cases = load_cases()
-    if not cases:
-        print("No cases found in medical_cases.json")
-        return
-        
-    results = []
-    total_questions = 0
-    
-    # Create or clear results.json
-    with open('results.json', 'w') as f:
-        json.dump([], f)
-    
-    for case_idx, case in enumerate(cases, 1):
+@cached_completion(validate=is_valid_diagnosis_response)
+@retry_api_call
+async def chat_completion(**kwargs):
+    """Return the completion text for a request, served from the response cache when possible."""
+    return await client.chat.completions.create(**kwargs)
+
+async def probabilistic_inference(doctor_vignette):
+    """Return the ranked differential and a question ruling out its least likely disease."""
+    answer = await chat_completion(
+        model="gpt-4o-mini",
+        messages=[
+            {"role": "system", "content": DIAGNOSIS_INSTRUCTIONS},
+            {"role": "user", "content": f"Patient Information: {doctor_vignette}"}
+        ],
+        response_format=DIAGNOSIS_RESPONSE_FORMAT
+    )
+    result = orjson.loads(answer)
+    diseases = [d.strip() for d in result["diseases"] if d.strip()]
+    return diseases, result["ruling_out_question"].strip()
+
+async def process_case(case_idx, case, semaphore):
+    """Run inference for a single case and return its result."""
+    async with semaphore:
         case_result = {
             "case_number": case_idx,
             "doctor_vignette": case['doctor_vignette'],
@@ -97,7 +131,7 @@ def main():
         
         print(f"\nProcessing Case {case_idx}...")
         doctor_vignette = case['doctor_vignette']
-        diseases = probabilistic_inference(doctor_vignette)
+        diseases, question = await probabilistic_inference(doctor_vignette)
         
         # Store all diseases
         case_result["diseases"] = diseases
@@ -106,29 +140,58 @@ def main():
         least_likely_disease = diseases[-1]
         case_result["least_likely_disease"] = least_likely_disease
         
-        # Generate one question to rule out the least likely disease
-        question = deductive_inference(doctor_vignette, least_likely_disease)
+        # Store the question ruling out the least likely disease
         case_result["ruling_out_question"] = question
+        return case_result
+
+async def main():
+    # Load cases from JSONL file
+    cases = load_cases()
+    if not cases:
+        print("No cases found in medical_cases.jsonl")
+        return
+        
+    results = []
+    total_questions = 0
+    
+    # Create or clear results.jsonl
+    writer = JsonlWriter('results.jsonl', truncate=True)
+    
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_CASES)
+    tasks = [process_case(case_idx, case, semaphore) for case_idx, case in enumerate(cases, 1)]
+    
+    # Report and save cases in completion order
+    for next_result in asyncio.as_completed(tasks):
+        try:
+            case_result = await next_result
+        except Exception as e:
+            print(f"Error processing case: {e}")
+            continue
         total_questions += 1
         
-        print(f"\nAll Diseases (most to least likely):")
-        for i, disease in enumerate(diseases, 1):
+        print(f"\nCase {case_result['case_number']} - All Diseases (most to least likely):")
+        for i, disease in enumerate(case_result["diseases"], 1):
             print(f"{i}. {disease}")
-        print(f"\nActual Diagnosis: {case['actual_diagnosis']}")
-        print(f"Least Likely Disease: {least_likely_disease}")
-        print(f"Ruling Out Question: {question}")
+        print(f"\nActual Diagnosis: {case_result['actual_diagnosis']}")
+        print(f"Least Likely Disease: {case_result['least_likely_disease']}")
+        print(f"Ruling Out Question: {case_result['ruling_out_question']}")
         
         # Add the new case result
         results.append(case_result)
         
-        # Update results.json after each case
-        with open('results.json', 'w') as f:
-            json.dump(results, f, indent=2)
-        print("\nUpdated results.json with current case")
+        # Append the case to results.jsonl
+        writer.append(case_result)
+    
+    writer.close()
+    
+    # Write the pretty-printed results once at the end, in case order
+    results.sort(key=lambda result: result["case_number"])
+    with open('results.json', 'wb', buffering=WRITE_BUFFER_SIZE) as f:
+        f.write(orjson.dumps(results, option=orjson.OPT_INDENT_2))
     
-    print(f"\nTotal cases processed: {len(cases)}")
+    print(f"\nTotal cases processed: {len(results)}/{len(cases)}")
     print(f"Total questions generated: {total_questions}")
     print("\nFinal results have been saved to results.json")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    asyncio.run(main())
@@ -0,0 +1,79 @@
+import functools
+import hashlib
+import inspect
+import orjson
+import sqlite3
+from typing import Optional
+
+CACHE_FILE = "response_cache.sqlite"
+
+class ResponseCache:
+    """Persistent SQLite store mapping a request hash to its completion text."""
+
+    def __init__(self, filename=CACHE_FILE):
+        self.conn = sqlite3.connect(filename, check_same_thread=False)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, content TEXT NOT NULL)")
+        self.conn.commit()
+
+    @staticmethod
+    def make_key(request: dict) -> str:
+        """Hash the model, messages and sampling parameters of a request."""
+        return hashlib.sha256(orjson.dumps(request, option=orjson.OPT_SORT_KEYS)).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        row = self.conn.execute("SELECT content FROM responses WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set(self, key: str, content: str):
+        self.conn.execute("INSERT OR REPLACE INTO responses (key, content) VALUES (?, ?)", (key, content))
+        self.conn.commit()
+
+_cache = None
+
+def get_cache() -> ResponseCache:
+    global _cache
+    if _cache is None:
+        _cache = ResponseCache()
+    return _cache
+
+def _should_cache(response, content, validate) -> bool:
+    """Only cache complete responses that pass the caller's validation."""
+    if not content or response.choices[0].finish_reason == "length":
+        return False
+    return validate is None or validate(content)
+
+def cached_completion(func=None, *, validate=None):
+    """Cache the text of chat completions returned by func, keyed on its request kwargs.
+
+    func must return the raw chat completion; the decorated function returns its
+    message text. Works for both sync and async functions. Identical requests are
+    served from disk instead of hitting the API again. Responses cut off at
+    max_tokens, or rejected by `validate(content)`, are returned but not cached.
+    """
+    if func is None:
+        return functools.partial(cached_completion, validate=validate)
+
+    if inspect.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper(**request):
+            key = ResponseCache.make_key(request)
+            content = get_cache().get(key)
+            if content is None:
+                response = await func(**request)
+                content = response.choices[0].message.content
+                if _should_cache(response, content, validate):
+                    get_cache().set(key, content)
+            return content
+        return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(**request):
+        key = ResponseCache.make_key(request)
+        content = get_cache().get(key)
+        if content is None:
+            response = func(**request)
+            content = response.choices[0].message.content
+            if _should_cache(response, content, validate):
+                get_cache().set(key, content)
+        return content
+    return wrapper